@@ -22,10 +22,25 @@
 #  along with this program; if not, see <http://www.gnu.org/licenses/>.
 ############################################################################
 import sys, os
-import platform, multiprocessing
-from subprocess import Popen, PIPE
-import contextlib
+import platform
+from subprocess import Popen, PIPE, call
+import shlex
+import re
 import argparse
+from collections import namedtuple
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+import threading
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 prog_description = 'Lima build and install tool'
 prog_instructions = '''
@@ -52,6 +67,14 @@ Description:
     If not absolute paths, the --config-file option will be assumed to be
     relative to the source-prefix, and --build-prefix relative to the CWD.
 
+    Values in config.txt can be enclosed in double quotes, which are
+    removed, and can reference environment variables as $VAR or ${VAR}.
+    No other shell processing is done on them.
+
+    On Linux, new build directories use the Ninja CMake generator if the
+    ninja program is found, and Unix Makefiles otherwise. An existing
+    build directory keeps the generator it was configured with.
+
 Module/option description:
     It can be any camera name or saving format.
     Available saving formats: edf, cbf, tiff, lz4, gz, hdf5, fits.
@@ -92,47 +115,90 @@ OS_TYPE = platform.system()
 if OS_TYPE not in ['Linux', 'Windows']:
 	sys.exit('Platform not supported: ' + OS_TYPE)
 
-def exec_cmd(cmd, exc_msg=''):
-	print('Executing:' + cmd)
-	sys.stdout.flush()
-	ret = os.system(cmd)
+nb_cpus = None
+
+def get_nb_cpus():
+	global nb_cpus
+	if nb_cpus is None:
+		try:
+			nb_cpus = os.cpu_count() or 1
+		except AttributeError:
+			# no os.cpu_count in Python 2
+			import multiprocessing
+			nb_cpus = multiprocessing.cpu_count()
+	return nb_cpus
+
+def to_underscore(x):
+	return x.replace('-', '_')
+
+def from_underscore(x):
+	return x.replace('_', '-')
+
+# argv is run without a shell; a string is split with shell-like syntax
+def exec_cmd(argv, exc_msg='', cwd=None):
+	if isinstance(argv, str):
+		argv = shlex.split(argv)
+	cmd = ' '.join(argv)
+	# a single write, so lines from parallel git commands do not mix.
+	# Non-interactive stderr is not line-buffered before Python 3.9
+	sys.stderr.write('Executing: %s\n' % cmd)
+	sys.stderr.flush()
+	try:
+		ret = call(argv, cwd=cwd)
+	except OSError:
+		# the program could not be executed, e.g. not found
+		ret = -1
 	if ret != 0:
 		raise Exception('%s [%s]' % (exc_msg, cmd))
 
 
-@contextlib.contextmanager
-def ch_dir(new_dir):
-	cur_dir = os.getcwd()
-	os.chdir(new_dir)
-	yield
-	os.chdir(cur_dir)
-
-
 class Config:
 
 	bool_map = {'yes': True, 'no': False}
 
+	# default option values are marked as '__<val>__'
+	bool_default_map = dict([(v, '__%s__' % o) 
+				 for o, v in bool_map.items()])
+	bool_opt_map = dict([(o, (v, True)) for o, v in bool_map.items()] +
+			    [('__%s__' % o, (v, False)) 
+			     for o, v in bool_map.items()])
+
+	# <dir>/<name> module options are passed as <prefix>-<name>
+	mod_opt_dir_map = {
+		'camera': 'limacamera',
+		'third-party': 'lima-enable',
+	}
+
+	# must be increased every time read_config parsing changes, so
+	# config caches written by older versions are ignored
+	config_cache_version = 2
+
+	# matches (OPT, VAL, '') for OPT=VAL lines, OPT can be a typed
+	# CMake VAR:TYPE, and ('', '', LINE) for invalid lines. Comments 
+	# and blank lines do not match
+	config_line_re = re.compile(r'^[ \t]*(?:#.*|'
+				    r'([^#=\s][^=\n]*?)[ \t]*=[ \t]*(.*?)|'
+				    r'(\S.*?))[ \t\r]*$', re.M)
+
 	@classmethod
 	def get_bool_opt_default(klass, val):
-		for o, v in klass.bool_map.items():
-			if val == v:
-				return '__%s__' % o
-		raise ValueError('Invalid value: ' + val)
+		if val not in klass.bool_default_map:
+			raise ValueError('Invalid value: %s' % val)
+		return klass.bool_default_map[val]
 
 	# return (val, explicit), where explicit is True if val was
 	# specified as argument, or False if val is the default option value
 	@classmethod
 	def get_bool_opt(klass, val):
 		val = val.lower()
-		for o, v in klass.bool_map.items():
-			if val == o:
-				return v, True
-			if val == '__%s__' % o:
-				return v, False
-		raise ValueError('Invalid value: ' + val)
+		if val not in klass.bool_opt_map:
+			raise ValueError('Invalid value: ' + val)
+		return klass.bool_opt_map[val]
 		
 	def __init__(self, argv=None):
 		self.cmd_opts = None
+		self.args_dict = None
+		self.cmd_opts_dict = None
 		self.config_opts = None
 		self.cmake_opts = None
 		self.git = None
@@ -173,6 +239,8 @@ class Config:
 		parser.add_argument('mod_opts', metavar='mod_opt', nargs='+',
 				    help='module/option to process')
 		self.cmd_opts = parser.parse_args(argv[1:])
+		self.args_dict = None
+		self.cmd_opts_dict = None
 
 		# do install if not explicitly specified and user
 		# included install-[python-]prefix
@@ -193,38 +261,89 @@ class Config:
 					self.set_cmd(opt, os.path.join(base, p))
 
 	def set_cmd(self, x, v):
-		setattr(self.cmd_opts, self.to_underscore(x), v)
+		setattr(self.cmd_opts, to_underscore(x), v)
+		self.args_dict = None
+		self.cmd_opts_dict = None
+
+	# parsed arguments by option name, cached until the next set_cmd
+	def get_args(self):
+		if self.args_dict is None:
+			args = self.cmd_opts._get_kwargs()
+			self.args_dict = dict([(from_underscore(k), v)
+					       for k, v in args])
+		return self.args_dict
 
 	def get(self, x):
-		return getattr(self.cmd_opts, self.to_underscore(x))
+		return self.get_args()[x]
 
 	def get_git_options(self):
 		return self.get('mod-opts')
 
+	# the returned dict is cached until the next set_cmd
 	def get_cmd_options(self):
-		opts = dict([(self.from_underscore(k), v)
-			     for k, v in self.cmd_opts._get_kwargs()])
+		if self.cmd_opts_dict is not None:
+			return self.cmd_opts_dict
+		opts = dict(self.get_args())
 		for arg in opts.pop('mod-opts'):
-			for oprefix, sdir in [("limacamera", "camera"), 
-					      ("lima-enable", "third-party")]:
-				sdir += '/'
-				if arg.startswith(sdir):
-					arg = oprefix + '-' + arg[len(sdir):]
+			sdir, sep, name = arg.partition('/')
+			if sep and sdir in self.mod_opt_dir_map:
+				arg = self.mod_opt_dir_map[sdir] + '-' + name
 			opts[arg] = True
+		self.cmd_opts_dict = opts
 		return opts
 
 	def read_config(self):
+		self.config_opts = [(opt, self.shell_value(val))
+				    for opt, val in self.load_config()]
+
+	# config values used to be passed through the shell: strip one
+	# pair of surrounding double quotes and expand $VAR references.
+	# This is not done in load_config, whose result is cached
+	@staticmethod
+	def shell_value(val):
+		if type(val) is not str:
+			return val
+		if len(val) >= 2 and val[0] == '"' and val[-1] == '"':
+			val = val[1:-1]
+		return os.path.expandvars(val)
+
+	# the parsed options are cached in the build directory, and reused
+	# as long as the config file is not modified
+	def load_config(self):
 		config_file = self.get('config-file')
-		self.config_opts = []
+		st = os.stat(config_file)
+		cache_key = (self.config_cache_version, config_file, 
+			     st.st_mtime, st.st_size)
+		cache_file = os.path.join(self.get('build-prefix'), 
+					  '.config_cache.pkl')
+		try:
+			with open(cache_file, 'rb') as f:
+				key, config_opts = pickle.load(f)
+			if key == cache_key:
+				return config_opts
+		except Exception:
+			pass
+
+		config_opts = []
 		with open(config_file) as f:
-			for line in f:
-				line = line.strip()
-				if not line or line.startswith('#'):
-					continue
-				opt, val = line.split('=')
-				opt = self.from_underscore(opt).lower()
-				val = int(val) if val.isdigit() else val
-				self.config_opts.append((opt, val))
+			data = f.read()
+		for opt, val, bad_line in self.config_line_re.findall(data):
+			if bad_line:
+				raise ValueError('Invalid line in %s: %s' % 
+						 (config_file, bad_line))
+			if not opt:
+				continue
+			opt = from_underscore(opt).lower()
+			val = int(val) if val.isdigit() else val
+			config_opts.append((opt, val))
+
+		try:
+			with open(cache_file, 'wb') as f:
+				pickle.dump((cache_key, config_opts), f,
+					    pickle.HIGHEST_PROTOCOL)
+		except (IOError, OSError):
+			pass
+		return config_opts
 
 	def get_config_options(self):
 		if self.config_opts is None:
@@ -236,13 +355,8 @@ class Config:
 		install_prefix = cmd_opts.get('install-prefix', '')
 		return cmd_opts.get('install', install_prefix != '')
 
-	@staticmethod
-	def to_underscore(x):
-		return x.replace('-', '_')
-
-	@staticmethod
-	def from_underscore(x):
-		return x.replace('_', '-')
+# CMake arguments of each build_install_lima step
+CMakePlan = namedtuple('CMakePlan', ['configure', 'build', 'install'])
 
 class CMakeOptions:
 
@@ -255,43 +369,71 @@ class CMakeOptions:
 
 	def __init__(self, cfg):
 		self.cfg = cfg
+		self.plan = None
+
+	# all the CMake arguments are computed only once
+	def get_plan(self):
+		if self.plan is None:
+			build_opts = ['--build', '.']
+			if OS_TYPE == 'Windows':
+				build_type = self.cfg.get('build-type')
+				build_opts += ['--config', build_type]
+			install_opts = build_opts + ['--target', 'install']
+			if OS_TYPE == 'Linux':
+				# both make and ninja accept -j
+				nb_jobs = get_nb_cpus() + 1
+				build_opts += ['--', '-j', str(nb_jobs)]
+			self.plan = CMakePlan(self.calc_configure_options(),
+					      build_opts, install_opts)
+		return self.plan
 
+	def get_configure_options(self):
+		return self.get_plan().configure
+
+	def get_build_options(self):
+		return self.get_plan().build
+
+	def get_install_options(self):
+		return self.get_plan().install
 
 	# return options in config file activated (=1) if passed as arguments,
 	# and also those not specified as empty (=) or disabled (=0|no) in file
-	def get_configure_options(self):
+	def calc_configure_options(self):
 		cmd_opts = self.cfg.get_cmd_options()
 		config_opts = self.cfg.get_config_options()
 
 		def is_active(v):
-			if type(val) in [bool, int]:
-				return val
-			return val and (val.lower() not in [str(0), 'no'])
+			if type(v) in [bool, int]:
+				return v
+			return v and (v.lower() not in [str(0), 'no'])
+
+		# arg-passed option must match the whole opt, or the end
+		# of opt and must be preceeded by the '-' separator
+		def find_cmd_opt(opt):
+			if opt in cmd_opts:
+				return opt
+			t = opt.split('-')
+			for i in range(1, len(t)):
+				suffix = '-'.join(t[i:])
+				if suffix in cmd_opts:
+					return suffix
 
 		cmake_opts = []
 		for opt, val in config_opts:
-			for cmd_opt, cmd_val in cmd_opts.items():
-				if cmd_opt == opt:
-					val = cmd_val
-					break
-				# arg-passed option must match the end
-				# of opt a nd must be preceeded by 
-				# the '_' separator
-				t = opt.split(cmd_opt)
-				if ((len(t) == 2) and 
-				    (t[0][-1] == '-') and not t[1]):
-					val = cmd_val
-					break
+			cmd_opt = find_cmd_opt(opt)
+			if cmd_opt is not None:
+				val = cmd_opts[cmd_opt]
 			if is_active(val):
 				cmake_opts.append((opt, val))
 
+		cmake_keys = set([opt for opt, val in cmake_opts])
 		for cmd_key, cmake_key in self.cmd_2_cmake_map:
 			val = self.cfg.get(cmd_key)
-			if is_active(val) and cmake_key not in dict(cmake_opts):
+			if is_active(val) and cmake_key not in cmake_keys:
 				cmake_opts.append((cmake_key, val))
 
 		if OS_TYPE == 'Linux':
-			cmake_gen = 'Unix Makefiles'
+			cmake_gen = self.get_linux_generator()
 		elif OS_TYPE == 'Windows':
 			# for windows check compat between installed python 
 			# and mandatory vc++ compiler
@@ -305,7 +447,7 @@ class CMakeOptions:
 			else:
 				win_compiler = "Visual Studio 15 2017"
 			# now check architecture
-			if platform.architecture()[0] == '64bit':
+			if sys.maxsize > 2**32:
 				win_compiler += ' Win64' 
 
 			print ('Found Python ', sys.version)
@@ -313,38 +455,34 @@ class CMakeOptions:
 			cmake_gen = win_compiler
 
 		source_prefix = self.cfg.get('source-prefix')
-		opts = [source_prefix, '-G"%s"' % cmake_gen]
-		opts += map(self.cmd_option, cmake_opts)
-		return self.get_cmd_line_from_options(opts)
-
-	def get_build_options(self):
-		opts = ['--build .']
-		if OS_TYPE == 'Linux':
-			nb_jobs = multiprocessing.cpu_count() + 1
-			opts += ['--', '-j %d' % nb_jobs]
-		if OS_TYPE == 'Windows':
-			opts += ['--config %s' %  self.cfg.get('build-type')]
-		return self.get_cmd_line_from_options(opts)
+		opts = [source_prefix, '-G', cmake_gen]
+		opts += [self.cmd_option(self.cmake_var(opt, val)) 
+			 for opt, val in cmake_opts]
+		return opts
 
-	def get_install_options(self):
-		opts = ['--build .', '--target install'] 
-		return self.get_cmd_line_from_options(opts)
+	# CMake refuses to change the generator of an existing build tree
+	def get_linux_generator(self):
+		build_prefix = self.cfg.get('build-prefix')
+		cache_file = os.path.join(build_prefix, 'CMakeCache.txt')
+		gen_prefix = 'CMAKE_GENERATOR:INTERNAL='
+		try:
+			with open(cache_file) as f:
+				for l in f:
+					if l.startswith(gen_prefix):
+						return l[len(gen_prefix):].strip()
+		except IOError:
+			pass
+		return 'Ninja' if which('ninja') else 'Unix Makefiles'
 
 	@staticmethod
-	def get_cmd_line_from_options(opts):
-		return ' '.join(['cmake'] + opts)
+	def cmake_var(opt, val):
+		if type(val) is bool:
+			val = int(val)
+		return to_underscore(opt).upper(), val
 
 	@staticmethod
-	def cmd_option(opt_val):
-		o, v = opt_val
-		def quoted(x):
-			if type(x) is bool:
-				x = int(x)
-			if type(x) is not str:
-				x = str(x)
-			return (('"%s"' % x) 
-				if ' ' in x and not x.startswith('"') else x)
-		return '-D%s=%s' % (Config.to_underscore(o).upper(), quoted(v))
+	def cmd_option(var_val):
+		return '-D%s=%s' % var_val
 
 
 class GitHelper:
@@ -364,9 +502,15 @@ class GitHelper:
 		'Processlib',
 	)
 
+	# "git submodule status" line: <flag><sha1> <path> [(<describe>)]
+	status_re = re.compile(r'(.)[0-9a-f]+ (\S+)')
+
 	def __init__(self, cfg):
 		self.cfg = cfg
 		self.opts = self.cfg.get_git_options()
+		self.nb_workers = min(32, get_nb_cpus() * 4)
+		self.tasks = queue.Queue()
+		self.errors = []
 
 	def check_submodules(self, submodules=None):
 		if submodules is None:
@@ -377,75 +521,190 @@ class GitHelper:
 				submodules.append(submod)
 
 		root = self.cfg.get('source-prefix')
-		with ch_dir(root):
-			submod_list = []
-			for submod in submodules:
-				if submod in self.not_submodules:
-					continue
-				if submod in self.submodule_map:
-					submod = self.submodule_map[submod]
-				for sdir in ['third-party', 'camera']:
-					s = os.path.join(sdir, submod)
-					if os.path.isdir(s):
-						submod = s
-						break
-				if os.path.isdir(submod):
-					submod_list.append(submod)
-
-			for submod in submod_list:
-				self.update_submodule(submod)
-
-	def update_submodule(self, submod):
+
+		# read each submodule directory only once. os.scandir gives
+		# the subdirectories without a stat per entry; without it
+		# (Python 2) all the names are kept and checked when matched
+		scandir = getattr(os, 'scandir', None)
+		def list_dir(d):
+			path = os.path.join(root, d)
+			try:
+				if scandir:
+					return set([e.name for e in scandir(path)
+						    if e.is_dir()])
+				return set(os.listdir(path))
+			except OSError:
+				return set()
+		sdir_entries = [(sdir, list_dir(sdir)) 
+				for sdir in ['third-party', 'camera']]
+
+		submod_list = []
+		for submod in submodules:
+			if submod in self.not_submodules:
+				continue
+			if submod in self.submodule_map:
+				submod = self.submodule_map[submod]
+			for sdir, entries in sdir_entries:
+				s = os.path.join(sdir, submod)
+				if submod in entries and (scandir or 
+				    os.path.isdir(os.path.join(root, s))):
+					submod = s
+					break
+			if os.path.isdir(os.path.join(root, submod)):
+				submod_list.append(submod)
+
+		outdated = self.get_outdated_submodules(root)
+		if outdated is not None:
+			def is_outdated(submod):
+				prefix = submod + '/'
+				for path in outdated:
+					if path == submod or path.startswith(prefix):
+						return True
+				return False
+			submod_list = list(filter(is_outdated, submod_list))
+		if not submod_list:
+			return
+
+		# a single init for all the submodules: it writes the root 
+		# .git/config, so it cannot be run in parallel
 		try:
-			action = 'init ' + submod
-			exec_cmd('git submodule ' + action)
-			action = 'update ' + submod
-			exec_cmd('git submodule ' + action)
-			with ch_dir(submod):
-				exec_cmd('git submodule init')
-				cmd = ['git', 'submodule']
-				p = Popen(cmd, stdout=PIPE)
-				for l in p.stdout.readlines():
-					tok = l.strip().split()
-					self.update_submodule(tok[1])
+			exec_cmd(['git', 'submodule', 'init'] + submod_list, 
+				 cwd=root)
 		except Exception as e:
-			sys.exit('Problem with submodule %s: %s' % (submod, e))
+			sys.exit('Problem with submodules %s: %s' % 
+				 (' '.join(submod_list), e))
+
+		nb_workers = min(self.nb_workers, len(submod_list))
+		workers = [threading.Thread(target=self.run_worker)
+			   for i in range(nb_workers)]
+		for t in workers:
+			t.start()
+		for submod in submod_list:
+			self.tasks.put((root, submod))
+		self.tasks.join()
+		for t in workers:
+			self.tasks.put(None)
+		for t in workers:
+			t.join()
+		if self.errors:
+			sys.exit('Problem with submodule %s: %s' % self.errors[0])
+
+	# return the submodules, nested ones included, that are not
+	# initialized or not checked out at the recorded commit, from a 
+	# single "git submodule status". Return None if it cannot be run.
+	# The output is parsed while git is still recursing
+	def get_outdated_submodules(self, root):
+		cmd = ['git', 'submodule', 'status', '--recursive']
+		try:
+			p = Popen(cmd, cwd=root, stdout=PIPE, 
+				  universal_newlines=True)
+		except OSError:
+			return None
+		outdated = []
+		for l in iter(p.stdout.readline, ''):
+			m = self.status_re.match(l)
+			if m and m.group(1) != ' ':
+				outdated.append(m.group(2))
+		p.stdout.close()
+		if p.wait() != 0:
+			return None
+		return outdated
+
+	def run_worker(self):
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				break
+			repo, submod = task
+			try:
+				self.update_submodule(repo, submod)
+			except Exception as e:
+				self.errors.append((submod, e))
+			finally:
+				self.tasks.task_done()
+
+	# nested submodules are initialized and updated by git itself
+	def update_submodule(self, repo, submod):
+		exec_cmd(['git', 'submodule', 'update', '--init', '--recursive',
+			  submod], cwd=repo)
+
+# run func in a separate thread; wait re-raises its exception, only once
+class BackgroundTask(threading.Thread):
+
+	def __init__(self, func):
+		threading.Thread.__init__(self)
+		self.func = func
+		self.exc = None
+
+	def run(self):
+		try:
+			self.func()
+		except BaseException as e:
+			self.exc = e
+
+	def wait(self):
+		self.join()
+		exc, self.exc = self.exc, None
+		if exc is not None:
+			raise exc
 
-def build_install_lima(cfg):
+
+# wait_sources, if given, is called before CMake needs the source tree
+def build_install_lima(cfg, wait_sources=None):
 	build_prefix = cfg.get('build-prefix')
 	if not os.path.exists(build_prefix):
 		os.mkdir(build_prefix)
-	os.chdir(build_prefix)
 
 	cmake_opts = CMakeOptions(cfg)
-	cmake_cmd = cmake_opts.get_configure_options()
-	exec_cmd(cmake_cmd, ('Something is wrong in CMake environment. ' +
-			     'Make sure your configuration is good.'))
-
-	cmake_cmd = cmake_opts.get_build_options()
-	exec_cmd(cmake_cmd, ('CMake could not build Lima. ' + 
-			     'Pleae contact lima@esrf.fr for help.'))
+	cmake_cmd = ['cmake'] + cmake_opts.get_configure_options()
+	if wait_sources:
+		wait_sources()
+	exec_cmd(cmake_cmd, ('Something is wrong in CMake environment. '
+			     'Make sure your configuration is good.'),
+		 cwd=build_prefix)
+
+	cmake_cmd = ['cmake'] + cmake_opts.get_build_options()
+	exec_cmd(cmake_cmd, ('CMake could not build Lima. '
+			     'Pleae contact lima@esrf.fr for help.'),
+		 cwd=build_prefix)
 
 	if not cfg.is_install_required():
 		return
 
-	cmake_cmd = cmake_opts.get_install_options()
-	exec_cmd(cmake_cmd, ('CMake could not install libraries. ' + 
-			     'Make sure you have necessary rights.'))
+	cmake_cmd = ['cmake'] + cmake_opts.get_install_options()
+	exec_cmd(cmake_cmd, ('CMake could not install libraries. '
+			     'Make sure you have necessary rights.'),
+		 cwd=build_prefix)
 
 
 def main():
 	cfg = Config(sys.argv)
 
 	# No git option under windows for obvious reasons.
+	# The submodules are updated while the build is being prepared
+	git_task = None
+	wait_sources = None
 	if OS_TYPE == 'Linux' and cfg.get('git'):
 		git = GitHelper(cfg)
-		git.check_submodules()
+		git_task = BackgroundTask(git.check_submodules)
+		git_task.start()
+		wait_sources = git_task.wait
 
+	errors = []
 	try:
-		build_install_lima(cfg)
+		build_install_lima(cfg, wait_sources)
 	except Exception as e:
-		sys.exit('Problem building/installing Lima: %s' % e)
+		errors.append('Problem building/installing Lima: %s' % e)
+	finally:
+		# if the build failed early, the submodule update must still
+		# be finished, and its own error reported
+		if git_task is not None:
+			try:
+				git_task.wait()
+			except BaseException as e:
+				errors.append(str(e))
+	if errors:
+		sys.exit('\n'.join(errors))
 
 
 